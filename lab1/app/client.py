@@ -2,6 +2,32 @@ import sys
 import socket
 import os
 
+RECV_SIZE = 65536
+
+
+def get_content_length(header_data):
+    for line in header_data.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            return int(value)
+    return None
+
+
+def iter_body(s, body, content_length):
+    # yields the body as it arrives, stopping at Content-Length (or when the server closes)
+    remaining = content_length
+    while True:
+        if body:
+            if remaining is not None:
+                body = body[:remaining]
+                remaining -= len(body)
+            yield body
+        if remaining == 0:
+            return
+        body = s.recv(RECV_SIZE)
+        if not body:
+            return
+
 
 def download_my_file(host, port, file, save_dir):
     try:
@@ -10,28 +36,38 @@ def download_my_file(host, port, file, save_dir):
 
             request_line = f"GET /{file} HTTP/1.1\r\nHost: {host}\r\n\r\n"
             s.sendall(request_line.encode())
-            response = b""
-            while True:
-                data = s.recv(4096)
+            # only the headers are buffered, the body goes straight to its destination
+            buffer = bytearray()
+            while b"\r\n\r\n" not in buffer:
+                data = s.recv(RECV_SIZE)
                 if not data:
                     break
-                response += data
-
-        header_data, _, body = response.partition(b"\r\n\r\n")
-        headers = header_data.decode()
-        status_line = headers.splitlines()[0]
-        if "200 OK" not in status_line:
-            print("Error: File not found or server error")
-            return False
-
-        if "Content-Type: text/html" in headers:
-            print(f"Client requested HTML file! Not saving to folder!")
-            print(body.decode("UTF-8"))
-        else:
-            save_path = os.path.join(save_dir, os.path.basename(file))
-            with open(save_path, 'wb') as f:
-                f.write(body)
-            print(f"Saved {file} to {save_dir}")
+                buffer += data
+
+            header_data, _, body = bytes(buffer).partition(b"\r\n\r\n")
+            status_line = header_data.split(b"\r\n", 1)[0]
+            if b" 200 " not in status_line:
+                print(f"Error: File not found or server error ({status_line.decode('ascii', 'replace')})")
+                return False
+
+            content_length = get_content_length(header_data)
+            received = 0
+            if b"Content-Type: text/html" in header_data:
+                print(f"Client requested HTML file! Not saving to folder!")
+                html = b"".join(iter_body(s, body, content_length))
+                received = len(html)
+                print(html.decode("UTF-8"))
+            else:
+                save_path = os.path.join(save_dir, os.path.basename(file))
+                with open(save_path, 'wb') as f:
+                    for chunk in iter_body(s, body, content_length):
+                        f.write(chunk)
+                        received += len(chunk)
+                print(f"Saved {file} to {save_dir}")
+
+            if content_length is not None and received < content_length:
+                print(f"Warning: connection closed after {received} of {content_length} bytes")
+                return False
         return True
     except Exception as e:
         print(f"Failed to download {file}: {e}")
@@ -1,13 +1,32 @@
+import logging
+import logging.handlers
+import mmap
 import os
+import queue
 import sys
 import socket
 import time
+from collections import OrderedDict
+from functools import lru_cache
+
+log = logging.getLogger("server")
+log.setLevel(os.getenv("LOGLEVEL", "WARNING").upper())  # LOGLEVEL=DEBUG shows every request
 
 CONTENT_TYPES = {
     ".html": "text/html",
     ".pdf": "application/pdf",
     ".png": "image/png"
 }
+FILE_CACHE_MAX_FILE = 1024 * 1024  # files up to this size are served from memory, bigger ones via sendfile
+FILE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+SMALL_RESPONSE_SIZE = 64 * 1024  # header and body go out in one sendall up to this size
+ERROR_PAGE_CACHE_SIZE = 128
+MMAP_MIN_SIZE = 64 * 1024  # without sendfile, bigger files are mapped instead of read
+LISTING_CACHE_SIZE = 128
+
+_listing_cache = {}  # (path, request_path, mtime) -> rendered listing
+_file_cache = OrderedDict()  # full_path -> ((mtime, size), full response), oldest first
+_file_cache_bytes = 0
 
 
 def get_content_type(filename):
@@ -15,30 +34,119 @@ def get_content_type(filename):
     return CONTENT_TYPES.get(extension, "application/octet-stream")
 
 
-def generate_directory_listing(path, request_path):
-    files = os.listdir(path)
-    parent_path = os.path.dirname(request_path.rstrip("/"))
-    if not parent_path:
-        parent_path = "/"
+def setup_logging():
+    # handlers only drop records on a queue, a background thread does the actual writing
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.propagate = False
+    listener.start()
+    return listener
+
+
+def make_header(status, content_type, length):
+    return (f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {length}\r\n"
+            "\r\n").encode('ascii')
+
+
+def send_response(conn, status, content_type, body):
+    header = make_header(status, content_type, len(body))
+    if len(body) <= SMALL_RESPONSE_SIZE:
+        conn.sendall(header + body)
+    else:
+        # big body, don't build a copy of it just to glue the header in front
+        conn.sendall(header)
+        conn.sendall(body)
+
+
+def send_file_body(conn, f, size):
+    # let the kernel copy the file straight into the socket
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(conn.fileno(), f.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (OSError, AttributeError):
+        # no sendfile on this platform, send whatever is left the old way
+        if size - offset < MMAP_MIN_SIZE:
+            f.seek(offset)
+            conn.sendall(f.read())
+            return
+        # map the file so sendall reads straight from the page cache
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                conn.sendall(view[offset:])
+
 
-    html = f"""
+def set_cork(conn, on):
+    # TCP_CORK (Linux only) holds partial packets until the response is written
+    if not hasattr(socket, 'TCP_CORK'):
+        return
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+    except OSError as e:
+        # only an optimization, a dead socket must still get closed by the caller
+        log.debug("Could not set TCP_CORK: %s", e)
+
+
+def set_nodelay(conn):
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        log.debug("Could not set TCP_NODELAY: %s", e)
+
+
+def get_cached_response(full_path):
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    cached = _file_cache.get(full_path)
+    if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+        return None
+    _file_cache.move_to_end(full_path)
+    return cached[1]
+
+
+def cache_response(full_path, st, response):
+    global _file_cache_bytes
+    old = _file_cache.pop(full_path, None)
+    if old is not None:
+        _file_cache_bytes -= len(old[1])
+    _file_cache[full_path] = ((st.st_mtime_ns, st.st_size), response)
+    _file_cache_bytes += len(response)
+    while _file_cache_bytes > FILE_CACHE_MAX_BYTES:
+        _, (_, evicted) = _file_cache.popitem(last=False)
+        _file_cache_bytes -= len(evicted)
+
+
+# everything up to the first row, only the request path (__REQ__) differs per call
+_LISTING_TEMPLATE = b"""
     <html>
     <head>
         <title>Janeta's Directory</title>
         <style>
-            body {{
+            body {
                 background-color: #fff6fa;
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 color: #4a4a4a;
                 text-align: center;
                 margin: 40px;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #e86ca1;
                 margin-bottom: 30px;
                 font-size: 26px;
-            }}
-            table {{
+            }
+            table {
                 margin: 0 auto;
                 border-collapse: collapse;
                 width: 70%;
@@ -46,203 +154,261 @@ def generate_directory_listing(path, request_path):
                 border-radius: 12px;
                 overflow: hidden;
                 box-shadow: 0px 2px 8px rgba(0,0,0,0.1);
-            }}
-            th {{
+            }
+            th {
                 background-color: #f9c9d4;
                 color: #4a4a4a;
                 padding: 12px;
                 font-size: 16px;
                 border-bottom: 2px solid #f2a8ba;
                 text-align: left;
-            }}
-            td {{
+            }
+            td {
                 padding: 10px;
                 border-bottom: 1px solid #f2f2f2;
                 text-align: left;
-            }}
-            tr:hover {{
+            }
+            tr:hover {
                 background-color: #ffe6ef;
-            }}
-            a {{
+            }
+            a {
                 color: #c84c86;
                 text-decoration: none;
                 font-weight: 500;
-            }}
-            a:hover {{
+            }
+            a:hover {
                 text-decoration: underline;
                 color: #ff69b4;
-            }}
-            footer {{
+            }
+            footer {
                 margin-top: 40px;
                 font-size: 14px;
                 color: #888;
-            }}
+            }
         </style>
     </head>
     <body>
-        <h2>Janeta's Directory Listing for {request_path}</h2>
+        <h2>Janeta's Directory Listing for __REQ__</h2>
         <table>
             <tr><th>Name</th><th>Type</th><th>Size</th></tr>
     """
+_LISTING_SUFFIX = b"""
+        </table>
+        <footer>Served with love by Janeta's Server &#128150;</footer>
+    </body>
+    </html>
+    """
+
+
+def generate_directory_listing(path, request_path):
+    # the directory mtime changes whenever an entry is added, removed or renamed
+    mtime = os.stat(path).st_mtime_ns
+    key = (path, request_path, mtime)
+    cached = _listing_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with os.scandir(path) as it:
+        entries = list(it)
+    parent_path = os.path.dirname(request_path.rstrip("/"))
+    if not parent_path:
+        parent_path = "/"
+
+    parts = [_LISTING_TEMPLATE.replace(b"__REQ__", request_path.encode('utf-8'))]
 
     # add the "../" link only if not in root
     if request_path.strip("/") != "":
-        html += f"""
+        parts.append(f"""
             <tr>
                 <td><a href="{parent_path}">../</a></td>
                 <td>-</td>
                 <td>-</td>
             </tr>
-        """
+        """.encode('utf-8'))
 
     # list all files and folders
-    for f in files:
-        full_path = os.path.join(path, f)
-        href = os.path.join(request_path, f).replace("\\", "/")
-        file_type = "Folder" if os.path.isdir(full_path) else "File"
-        size = "-" if os.path.isdir(full_path) else f"{os.path.getsize(full_path)} bytes"
-        display_name = f + "/" if os.path.isdir(full_path) else f
-        html += f"""
+    base_href = request_path.rstrip("/") + "/"
+    for entry in entries:
+        is_dir = entry.is_dir()
+        href = base_href + entry.name
+        file_type = "Folder" if is_dir else "File"
+        size = "-" if is_dir else f"{entry.stat().st_size} bytes"
+        display_name = entry.name + "/" if is_dir else entry.name
+        parts.append(f"""
             <tr>
                 <td><a href="{href}">{display_name}</a></td>
                 <td>{file_type}</td>
                 <td>{size}</td>
             </tr>
-        """
+        """.encode('utf-8'))
 
-    html += """
-        </table>
-        <footer>Served with love by Janeta's Server &#128150;</footer>
-    </body>
-    </html>
-    """
-    return html.encode('utf-8')
+    parts.append(_LISTING_SUFFIX)
+    html = b"".join(parts)
 
+    if len(_listing_cache) >= LISTING_CACHE_SIZE:
+        _listing_cache.pop(next(iter(_listing_cache)))  # drop the oldest listing
+    _listing_cache[key] = html
+    return html
 
-def generate_404_page(request_path):
-    parent_path = os.path.dirname(request_path.rstrip("/")) or "/"
-    html = f"""
+
+_404_PREFIX = b"""
     <html>
     <head>
         <title>404 Not Found</title>
         <style>
-            body {{
+            body {
                 background-color: #fff6fa;
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 color: #4a4a4a;
                 text-align: center;
                 margin: 80px;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #e86ca1;
                 font-size: 32px;
                 margin-bottom: 20px;
-            }}
-            a {{
+            }
+            a {
                 color: #c84c86;
                 text-decoration: none;
                 font-weight: 500;
                 font-size: 20px;
-            }}
-            a:hover {{
+            }
+            a:hover {
                 text-decoration: underline;
                 color: #ff69b4;
-            }}
-            p {{
+            }
+            p {
                 font-size: 18px;
                 margin-top: 20px;
-            }}
-            footer {{
+            }
+            footer {
                 margin-top: 40px;
                 font-size: 14px;
                 color: #888;
-            }}
+            }
         </style>
     </head>
     <body>
-        <a href="{parent_path}">&#8592 Go Back</a>
+"""
+_404_SUFFIX = b"""
         <h2>404 Not Found &#128148</h2>
         <p>The page or file you are looking for does not exist.</p>
         <footer>Served with love by Janeta's Server &#128150</footer>
     </body>
     </html>
     """
-    return html.encode('utf-8')
+
+
+def generate_404_page(request_path):
+    parent_path = os.path.dirname(request_path.rstrip("/")) or "/"
+    return render_404_page(parent_path)
+
+
+@lru_cache(maxsize=ERROR_PAGE_CACHE_SIZE)
+def render_404_page(parent_path):
+    # the page only changes with where the "Go Back" link points
+    back_link = f"""        <a href="{parent_path}">&#8592 Go Back</a>""".encode('utf-8')
+    return b"".join([_404_PREFIX, back_link, _404_SUFFIX])
+
+
+# error responses for the root never change, so they are fully built once at import
+_BODY_404 = generate_404_page("/")
+_RESP_404 = make_header("404 Not Found", "text/html", len(_BODY_404)) + _BODY_404
+_RESP_400 = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+_RESP_500 = b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n"
+_RESP_405 = b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET\r\nContent-Length: 0\r\n\r\n"
 
 
 def handle_client(conn, base_dir):
+    set_cork(conn, True)
     try:
-        request = conn.recv(1024).decode('utf-8')
+        request = conn.recv(1024)
         if not request:
             return
 
-        request_line = request.splitlines()[0]
-        method, path, _ = request_line.split()
+        # only the request line matters, so it is picked apart as bytes without decoding it all
+        line_end = request.find(b"\r\n")
+        request_line = request[:line_end].split(b" ", 2) if line_end != -1 else []
+        if len(request_line) != 3:
+            conn.sendall(_RESP_400)
+            return
+        method, path, _ = request_line
 
-        if method != "GET":
-            response = generate_404_page("/")
-            conn.sendall(response)
+        if method != b"GET":
+            conn.sendall(_RESP_405)
             return
 
-        path = path.lstrip('/')
+        path = path.decode('utf-8', 'replace').lstrip('/')
         full_path = os.path.join(base_dir, path)
-        print(f"Client requested: {full_path}")
+        log.debug("Client requested: %s", full_path)
         if os.path.isdir(full_path):
             body = generate_directory_listing(full_path, '/' + path)
-            header = (
-                "HTTP/1.1 200 OK\r\n"
-                "Content-Type: text/html\r\n"
-                f"Content-Length: {len(body)}\r\n"
-                "\r\n"
-            )
-            conn.sendall(header.encode('utf-8') + body)
+            send_response(conn, "200 OK", "text/html", body)
 
         elif os.path.isfile(full_path):
             content_type = get_content_type(full_path)
+            cached = get_cached_response(full_path)
+            if cached is not None:
+                conn.sendall(cached)
+                return
             try:
-                with open(full_path, "rb") as f:
+                f = open(full_path, "rb")
+            except OSError as e:
+                log.warning("Could not open %s: %s", full_path, e)
+                send_response(conn, "404 Not Found", "text/html", generate_404_page(path))
+                return
+            with f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                if size <= FILE_CACHE_MAX_FILE:
                     content = f.read()
-                header = ("HTTP/1.1 200 OK\r\n"
-                          f"Content-Type: {content_type}\r\n"
-                          f"Content-Length: {len(content)}\r\n"
-                          "\r\n"
-                          )
-                conn.sendall(header.encode('utf-8') + content)
-            except:
-                conn.sendall(generate_404_page(path))  # changed to 404
+                    response = make_header("200 OK", content_type, len(content)) + content
+                    cache_response(full_path, st, response)
+                    conn.sendall(response)
+                else:
+                    conn.sendall(make_header("200 OK", content_type, size))
+                    send_file_body(conn, f, size)
 
         else:
             body = generate_404_page(path)
-            header = (
-                "HTTP/1.1 404 Not Found\r\n"
-                "Content-Type: text/html\r\n"
-                f"Content-Length: {len(body)}\r\n"
-                "\r\n"
-            )
-            conn.sendall(header.encode('utf-8') + body)
-    except Exception as e:
-        print(f"Error handling client: {e}")
-        body = generate_404_page("/")
-        header = (
-            "HTTP/1.1 404 Not Found\r\n"
-            "Content-Type: text/html\r\n"
-            f"Content-Length: {len(body)}\r\n"
-            "\r\n"
-        )
-        conn.sendall(header.encode('utf-8') + body)
+            send_response(conn, "404 Not Found", "text/html", body)
+    except (OSError, ValueError) as e:
+        log.error("Error handling client: %s", e)
+        try:
+            conn.sendall(_RESP_404)
+        except OSError:
+            pass  # the client is already gone
+    except Exception:
+        # a bug, not a client problem: keep the traceback, one bad request must not take the server down
+        log.exception("Unexpected error handling client")
+        try:
+            conn.sendall(_RESP_500)
+        except OSError:
+            pass
+    finally:
+        set_cork(conn, False)
 
 
 def run_server(base_dir, host='0.0.0.0', port=8000):
+    setup_logging()
     print(f"Now listening on http://localhost:{port} directory: {base_dir}")
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # rebind right away after a restart, and let several server processes share the port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((host, port))
-        s.listen(1)
+        s.listen(socket.SOMAXCONN)
         while True:
             conn, addr = s.accept()
-            print(f"Connection from {addr}")
-            handle_client(conn, base_dir)
-            conn.close()
+            set_nodelay(conn)
+            log.debug("Connection from %s", addr)
+            try:
+                handle_client(conn, base_dir)
+            finally:
+                conn.close()
 
 
 if __name__ == "__main__":
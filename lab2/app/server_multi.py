@@ -1,20 +1,50 @@
+import logging
+import logging.handlers
+import mmap
 import os
+import queue
 import sys
 import socket
+import struct
 import threading
 import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("server")
+log.setLevel(os.getenv("LOGLEVEL", "WARNING").upper())  # LOGLEVEL=DEBUG shows every request
 
 CONTENT_TYPES = {
     ".html": "text/html",
     ".pdf": "application/pdf",
     ".png": "image/png"
 }
+FILE_CACHE_MAX_FILE = 1024 * 1024  # files up to this size are served from memory, bigger ones via sendfile
+FILE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+SMALL_RESPONSE_SIZE = 64 * 1024  # header and body go out in one sendall up to this size
+MMAP_MIN_SIZE = 64 * 1024  # without sendfile, bigger files are mapped instead of read
 
-request_counts_per_file = {}
-counter_lock = threading.Lock()
+request_counts_per_file = Counter()
+counter_lock = threading.Lock()  # guards request_times_per_ip
 request_times_per_ip = {}
 RATE_LIMIT = 5
 TIME_WINDOW = 1  # seconds
+DEBUG_SLOW = False  # adds a 1s delay per request, handy for showing off concurrency
+MAX_WORKERS = 128  # upper bound on threads serving clients at the same time
+MAX_PENDING = 4 * MAX_WORKERS  # accepted connections waiting for or holding a worker
+RECV_TIMEOUT = 1  # seconds a client gets to send its request before its worker is freed
+LISTING_CACHE_SIZE = 128
+pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+pending_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+# (path, mtime) -> [(name, is_dir, size), ...]; the hits column changes on every
+# request, so only the directory scan is cached and the rows are rendered each time
+_listing_cache = {}
+listing_cache_lock = threading.Lock()
+
+_file_cache = OrderedDict()  # full_path -> ((mtime, size), full response), oldest first
+_file_cache_bytes = 0
+file_cache_lock = threading.Lock()
 
 
 def get_content_type(filename):
@@ -22,30 +52,150 @@ def get_content_type(filename):
     return CONTENT_TYPES.get(extension, "application/octet-stream")
 
 
-def generate_directory_listing(path, request_path):
-    files = os.listdir(path)
-    parent_path = os.path.dirname(request_path.rstrip("/"))
-    if not parent_path:
-        parent_path = "/"
+def setup_logging():
+    # handlers only drop records on a queue, a background thread does the actual writing
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.propagate = False
+    listener.start()
+    return listener
+
+
+def make_header(status, content_type, length):
+    return (f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {length}\r\n"
+            "\r\n").encode('ascii')
+
+
+def send_response(conn, status, content_type, body):
+    header = make_header(status, content_type, len(body))
+    if len(body) <= SMALL_RESPONSE_SIZE:
+        conn.sendall(header + body)
+    else:
+        # big body, don't build a copy of it just to glue the header in front
+        conn.sendall(header)
+        conn.sendall(body)
+
+
+def send_file_body(conn, f, size):
+    # let the kernel copy the file straight into the socket
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(conn.fileno(), f.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (OSError, AttributeError):
+        # no sendfile on this platform, send whatever is left the old way
+        if size - offset < MMAP_MIN_SIZE:
+            f.seek(offset)
+            conn.sendall(f.read())
+            return
+        # map the file so sendall reads straight from the page cache
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                conn.sendall(view[offset:])
+
+
+def set_cork(conn, on):
+    # TCP_CORK (Linux only) holds partial packets until the response is written
+    if not hasattr(socket, 'TCP_CORK'):
+        return
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+    except OSError as e:
+        # only an optimization, a dead socket must still get closed by the caller
+        log.debug("Could not set TCP_CORK: %s", e)
+
+
+def set_recv_timeout(conn):
+    # SO_RCVTIMEO only limits recv and keeps the socket blocking, so os.sendfile works as before
+    try:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", RECV_TIMEOUT, 0))
+    except OSError as e:
+        log.debug("Could not set SO_RCVTIMEO: %s", e)
+
+
+def set_nodelay(conn):
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        log.debug("Could not set TCP_NODELAY: %s", e)
+
 
-    html = f"""
+def get_cached_response(full_path):
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    with file_cache_lock:
+        cached = _file_cache.get(full_path)
+        if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+            return None
+        _file_cache.move_to_end(full_path)
+        return cached[1]
+
+
+def cache_response(full_path, st, response):
+    global _file_cache_bytes
+    with file_cache_lock:
+        old = _file_cache.pop(full_path, None)
+        if old is not None:
+            _file_cache_bytes -= len(old[1])
+        _file_cache[full_path] = ((st.st_mtime_ns, st.st_size), response)
+        _file_cache_bytes += len(response)
+        while _file_cache_bytes > FILE_CACHE_MAX_BYTES:
+            _, (_, evicted) = _file_cache.popitem(last=False)
+            _file_cache_bytes -= len(evicted)
+
+
+def scan_directory(path):
+    # the directory mtime changes whenever an entry is added, removed or renamed
+    key = (path, os.stat(path).st_mtime_ns)
+    cached = _listing_cache.get(key)
+    if cached is not None:
+        return cached
+
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # is_dir() comes from readdir's d_type, so only files cost a stat call
+            is_dir = entry.is_dir()
+            entries.append((entry.name, is_dir, None if is_dir else entry.stat().st_size))
+
+    with listing_cache_lock:
+        if len(_listing_cache) >= LISTING_CACHE_SIZE:
+            _listing_cache.pop(next(iter(_listing_cache)))  # drop the oldest scan
+        _listing_cache[key] = entries
+    return entries
+
+
+# everything up to the first row, only the request path (__REQ__) differs per call
+_LISTING_TEMPLATE = b"""
     <html>
     <head>
         <title>Janeta's Directory</title>
         <style>
-            body {{
+            body {
                 background-color: #fff6fa;
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 color: #4a4a4a;
                 text-align: center;
                 margin: 40px;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #e86ca1;
                 margin-bottom: 30px;
                 font-size: 26px;
-            }}
-            table {{
+            }
+            table {
                 margin: 0 auto;
                 border-collapse: collapse;
                 width: 70%;
@@ -53,181 +203,195 @@ def generate_directory_listing(path, request_path):
                 border-radius: 12px;
                 overflow: hidden;
                 box-shadow: 0px 2px 8px rgba(0,0,0,0.1);
-            }}
-            th {{
+            }
+            th {
                 background-color: #f9c9d4;
                 color: #4a4a4a;
                 padding: 12px;
                 font-size: 16px;
                 border-bottom: 2px solid #f2a8ba;
                 text-align: left;
-            }}
-            td {{
+            }
+            td {
                 padding: 10px;
                 border-bottom: 1px solid #f2f2f2;
                 text-align: left;
-            }}
-            tr:hover {{
+            }
+            tr:hover {
                 background-color: #ffe6ef;
-            }}
-            a {{
+            }
+            a {
                 color: #c84c86;
                 text-decoration: none;
                 font-weight: 500;
-            }}
-            a:hover {{
+            }
+            a:hover {
                 text-decoration: underline;
                 color: #ff69b4;
-            }}
-            footer {{
+            }
+            footer {
                 margin-top: 40px;
                 font-size: 14px;
                 color: #888;
-            }}
+            }
         </style>
     </head>
     <body>
-        <h2>Janeta's Directory Listing for {request_path}</h2>
+        <h2>Janeta's Directory Listing for __REQ__</h2>
         <table>
             <tr><th>Name</th><th>Type</th><th>Size</th><th>Hits</th></tr>
     """
+_LISTING_SUFFIX = b"""
+        </table>
+        <footer>Served with love by Janeta's Server &#128150;</footer>
+    </body>
+    </html>
+    """
+
+
+def generate_directory_listing(path, request_path):
+    entries = scan_directory(path)
+    parent_path = os.path.dirname(request_path.rstrip("/"))
+    if not parent_path:
+        parent_path = "/"
+
+    parts = [_LISTING_TEMPLATE.replace(b"__REQ__", request_path.encode('utf-8'))]
 
     # add the "../" link only if not in root
     if request_path.strip("/") != "":
-        html += f"""
+        parts.append(f"""
             <tr>
                 <td><a href="{parent_path}">../</a></td>
                 <td>-</td>
                 <td>-</td>
                 <td>-</td>
             </tr>
-        """
+        """.encode('utf-8'))
 
     # list all files and folders
-    for f in files:
-        full_path = os.path.join(path, f)
+    base_href = request_path.rstrip("/") + "/"
+    for name, is_dir, file_size in entries:
+        full_path = os.path.join(path, name)
         hits = request_counts_per_file.get(full_path, 0)
         # print(f"FOR {full_path}")
-        href = os.path.join(request_path, f).replace("\\", "/")
-        file_type = "Folder" if os.path.isdir(full_path) else "File"
-        size = "-" if os.path.isdir(full_path) else f"{os.path.getsize(full_path)} bytes"
-        display_name = f + "/" if os.path.isdir(full_path) else f
-        html += f"""
+        href = base_href + name
+        file_type = "Folder" if is_dir else "File"
+        size = "-" if is_dir else f"{file_size} bytes"
+        display_name = name + "/" if is_dir else name
+        parts.append(f"""
             <tr>
                 <td><a href="{href}">{display_name}</a></td>
                 <td>{file_type}</td>
                 <td>{size}</td>
                 <td>{hits}</td>
             </tr>
-        """
+        """.encode('utf-8'))
 
-    html += """
-        </table>
-        <footer>Served with love by Janeta's Server &#128150;</footer>
-    </body>
-    </html>
-    """
-    return html.encode('utf-8')
+    parts.append(_LISTING_SUFFIX)
+    return b"".join(parts)
 
 
-def generate_404_page(request_path):
-    parent_path = os.path.dirname(request_path.rstrip("/")) or "/"
-    html = f"""
+_404_PREFIX = b"""
     <html>
     <head>
         <title>404 Not Found</title>
         <style>
-            body {{
+            body {
                 background-color: #fff6fa;
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 color: #4a4a4a;
                 text-align: center;
                 margin: 80px;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #e86ca1;
                 font-size: 32px;
                 margin-bottom: 20px;
-            }}
-            a {{
+            }
+            a {
                 color: #c84c86;
                 text-decoration: none;
                 font-weight: 500;
                 font-size: 20px;
-            }}
-            a:hover {{
+            }
+            a:hover {
                 text-decoration: underline;
                 color: #ff69b4;
-            }}
-            p {{
+            }
+            p {
                 font-size: 18px;
                 margin-top: 20px;
-            }}
-            footer {{
+            }
+            footer {
                 margin-top: 40px;
                 font-size: 14px;
                 color: #888;
-            }}
+            }
         </style>
     </head>
     <body>
-        <a href="{parent_path}">&#8592 Go Back</a>
+"""
+_404_SUFFIX = b"""
         <h2>404 Not Found &#128148</h2>
         <p>The page or file you are looking for does not exist.</p>
         <footer>Served with love by Janeta's Server &#128150</footer>
     </body>
     </html>
     """
-    return html.encode('utf-8')
 
 
-def generate_429_page(request_path):
+def generate_404_page(request_path):
     parent_path = os.path.dirname(request_path.rstrip("/")) or "/"
-    html = f"""
+    back_link = f"""        <a href="{parent_path}">&#8592 Go Back</a>""".encode('utf-8')
+    return b"".join([_404_PREFIX, back_link, _404_SUFFIX])
+
+
+_429_PREFIX = b"""
     <html>
     <head>
         <title>429 Too Many Requests</title>
         <style>
-            body {{
+            body {
                 background-color: #fff6fa;
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 color: #4a4a4a;
                 text-align: center;
                 margin: 80px;
-            }}
-            h1 {{
+            }
+            h1 {
                 color: #e86ca1;
                 font-size: 48px;
                 margin-bottom: 10px;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #e86ca1;
                 font-size: 26px;
                 margin-bottom: 30px;
-            }}
-            a {{
+            }
+            a {
                 color: #c84c86;
                 text-decoration: none;
                 font-weight: 500;
                 font-size: 20px;
-            }}
-            a:hover {{
+            }
+            a:hover {
                 text-decoration: underline;
                 color: #ff69b4;
-            }}
-            p {{
+            }
+            p {
                 font-size: 18px;
                 margin-top: 20px;
-            }}
-            footer {{
+            }
+            footer {
                 margin-top: 40px;
                 font-size: 14px;
                 color: #888;
-            }}
+            }
         </style>
     </head>
     <body>
-        <a href="{parent_path}">&#8592 Go Back</a>
+"""
+_429_SUFFIX = b"""
         <h1>429</h1>
         <h2>&#128683 Too Many Requests &#128683</h2>
         <p>Whoa! Slow down! &#9995 You're sending too many requests, I can't keep up. &#128544</p>
@@ -235,124 +399,151 @@ def generate_429_page(request_path):
     </body>
     </html>
     """
-    return html.encode('utf-8')
+
+
+def generate_429_page(request_path):
+    parent_path = os.path.dirname(request_path.rstrip("/")) or "/"
+    back_link = f"""        <a href="{parent_path}">&#8592 Go Back</a>""".encode('utf-8')
+    return b"".join([_429_PREFIX, back_link, _429_SUFFIX])
+
+
+# error responses never change, so they are fully built once at import
+_BODY_404 = b"<html><h1>404 Not Found</h1></html>"
+_RESP_404 = make_header("404 Not Found", "text/html", len(_BODY_404)) + _BODY_404
+_BODY_429 = generate_429_page("/")
+_RESP_429 = make_header("429 Too Many Requests", "text/html", len(_BODY_429)) + _BODY_429
+_RESP_400 = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+_RESP_500 = b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n"
+_RESP_405 = b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET\r\nContent-Length: 0\r\n\r\n"
 
 
 def handle_client(conn, addr, base_dir):
+    set_cork(conn, True)
     try:
         client_ip = addr[0]
         now = time.time()
 
         with counter_lock:
             if client_ip not in request_times_per_ip:
-                request_times_per_ip[client_ip] = []
-
-            request_times_per_ip[client_ip] = [t for t in request_times_per_ip[client_ip] if now - t < TIME_WINDOW]
-
-            if len(request_times_per_ip[client_ip]) >= RATE_LIMIT:
-                body = generate_429_page("/")
-                header = (
-                    "HTTP/1.1 429 Too Many Requests\r\n"
-                    "Content-Type: text/html\r\n"
-                    f"Content-Length: {len(body)}\r\n"
-                    "\r\n"
-                )
-                conn.sendall(header.encode("utf-8") + body)
-            request_times_per_ip[client_ip].append(now)
-
-        request = conn.recv(1024).decode()
-        time.sleep(1)
+                # only the last RATE_LIMIT requests matter, older ones fall off the left
+                request_times_per_ip[client_ip] = deque(maxlen=RATE_LIMIT)
+            request_times = request_times_per_ip[client_ip]
+
+            while request_times and now - request_times[0] >= TIME_WINDOW:
+                request_times.popleft()
+
+            limited = len(request_times) >= RATE_LIMIT
+            request_times.append(now)
+
+        # sent outside the lock so a slow client can't hold up everyone else's check
+        if limited:
+            conn.recv(1024)  # read the request first, closing with it unread resets the connection
+            conn.sendall(_RESP_429)
+            return
+
+        request = conn.recv(1024)
+        if DEBUG_SLOW:
+            time.sleep(1)
         if not request:
             return
 
-        request_line = request.splitlines()[0]
-        method, path, _ = request_line.split()
+        # only the request line matters, so it is picked apart as bytes without decoding it all
+        line_end = request.find(b"\r\n")
+        request_line = request[:line_end].split(b" ", 2) if line_end != -1 else []
+        if len(request_line) != 3:
+            conn.sendall(_RESP_400)
+            return
+        method, path, _ = request_line
 
-        if method != "GET":
-            response = (
-                "HTTP/1.1 404 Not Found\r\n"
-                "\r\n"
-            )
-            conn.sendall(response.encode())
+        if method != b"GET":
+            conn.sendall(_RESP_405)
             return
 
-        path = path.lstrip('/')
+        path = path.decode('utf-8', 'replace').lstrip('/')
         full_path = os.path.join(base_dir, path)
         full_path = os.path.normpath(full_path)
-        print(f"Client {client_ip} requested: {full_path}")
+        log.debug("Client %s requested: %s", client_ip, full_path)
         # if full_path not in request_counts_per_file:
         #     request_counts_per_file[full_path] = 0
         # current = request_counts_per_file[full_path]
         # time.sleep(0.1)
         # request_counts_per_file[full_path] = current + 1  # naive increment
 
-        with counter_lock:
-            if full_path not in request_counts_per_file:
-                request_counts_per_file[full_path] = 0
-            # current = request_counts_per_file[full_path]
-            # time.sleep(0.1)
-            # request_counts_per_file[full_path] = current + 1
-            request_counts_per_file[full_path] += 1
-            # print(f"{full_path} incremented to {request_counts_per_file[full_path]}")
-            # print(f"ALL the hits: {request_counts_per_file}")
+        # Counter.update counts the key in one C call (unlike "+= 1", which is a separate
+        # read and write), so under the GIL no other thread can slip in between and no lock is needed
+        request_counts_per_file.update((full_path,))
         if os.path.isdir(full_path):
             body = generate_directory_listing(full_path, '/' + path)
-            header = (
-                "HTTP/1.1 200 OK\r\n"
-                "Content-Type: text/html\r\n"
-                f"Content-Length: {len(body)}\r\n"
-                "\r\n"
-            )
-            conn.sendall(header.encode() + body)
+            send_response(conn, "200 OK", "text/html", body)
 
         elif os.path.isfile(full_path):
             content_type = get_content_type(full_path)
+            cached = get_cached_response(full_path)
+            if cached is not None:
+                conn.sendall(cached)
+                return
             try:
-                with open(full_path, "rb") as f:
+                f = open(full_path, "rb")
+            except OSError as e:
+                log.warning("Could not open %s: %s", full_path, e)
+                conn.sendall(_RESP_404)
+                return
+            with f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                if size <= FILE_CACHE_MAX_FILE:
                     content = f.read()
-                header = ("HTTP/1.1 200 OK\r\n"
-                          f"Content-Type: {content_type}\r\n"
-                          f"Content-Length: {len(content)}\r\n"
-                          "\r\n"
-                          )
-                conn.sendall(header.encode("utf-8") + content)
-            except:
-                conn.sendall(b"HTTP/1.1 404 Not Found\r\n\r\n")
+                    response = make_header("200 OK", content_type, len(content)) + content
+                    cache_response(full_path, st, response)
+                    conn.sendall(response)
+                else:
+                    conn.sendall(make_header("200 OK", content_type, size))
+                    send_file_body(conn, f, size)
 
         else:
-            body = b"<html><h1>404 Not Found</h1></html>"
-            header = (
-                "HTTP/1.1 404 Not Found\r\n"
-                "Content-Type: text/html\r\n"
-                f"Content-Length: {len(body)}\r\n"
-                "\r\n"
-            )
-            conn.sendall(header.encode() + body)
-    except Exception as e:
-        print(f"Error handling client: {e}")
-        body = b"<html><h1>404 Not Found</h1></html>"
-        header = (
-            "HTTP/1.1 404 Not Found\r\n"
-            "Content-Type: text/html\r\n"
-            f"Content-Length: {len(body)}\r\n"
-            "\r\n"
-        )
-        conn.sendall(header.encode('utf-8') + body)
+            conn.sendall(_RESP_404)
+    except BlockingIOError:
+        # recv hit RECV_TIMEOUT, an idle client doesn't get to keep the worker
+        log.debug("Client %s sent nothing in %ss, closing", addr, RECV_TIMEOUT)
+    except (OSError, ValueError) as e:
+        log.error("Error handling client: %s", e)
+        try:
+            conn.sendall(_RESP_404)
+        except OSError:
+            pass  # the client is already gone
+    except Exception:
+        # a bug, not a client problem: keep the traceback, one bad request must not take the server down
+        log.exception("Unexpected error handling client")
+        try:
+            conn.sendall(_RESP_500)
+        except OSError:
+            pass
     finally:
+        set_cork(conn, False)
         conn.close()  # closing after handling the client
 
 
 def run_server(base_dir, host='0.0.0.0', port=8000):
+    setup_logging()
     print(f"Now listening on http://localhost:{port} directory: {base_dir}")
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # rebind right away after a restart, and let several server processes share the port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((host, port))
-        s.listen(10)
+        s.listen(socket.SOMAXCONN)
         while True:
+            # with MAX_PENDING connections in flight stop accepting, new ones wait in the
+            # listen backlog until a worker frees a slot instead of piling up open fds here
+            pending_slots.acquire()
             conn, addr = s.accept()
-            print(f"Connection from {addr}")
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr, base_dir))
-            client_thread.start()
+            set_nodelay(conn)
+            set_recv_timeout(conn)
+            log.debug("Connection from %s", addr)
+            future = pool.submit(handle_client, conn, addr, base_dir)
+            future.add_done_callback(lambda _: pending_slots.release())
             # handle_client(conn, base_dir)
 
 
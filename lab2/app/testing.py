@@ -1,3 +1,5 @@
+import queue
+import select
 import socket
 import threading
 import time
@@ -10,35 +12,98 @@ paths = [
 HOST = "localhost"
 PORT = 8000
 NUM_REQUESTS = 10
+RECV_SIZE = 65536
 
 results = []  # to store status codes
 lock = threading.Lock()
 MODE = "paced"   # "spam" or "paced"
 DELAY = 0.25     # (4 req/sec)
 
+idle_connections = queue.SimpleQueue()  # keep-alive sockets ready for the next request
+
+
+def get_connection():
+    while True:
+        try:
+            s = idle_connections.get_nowait()
+        except queue.Empty:
+            return socket.create_connection((HOST, PORT)), False
+        # an idle socket only becomes readable once the server has closed it
+        readable, _, _ = select.select([s], [], [], 0)
+        if not readable:
+            return s, True
+        s.close()
+
+
+def read_response(s):
+    # reads exactly one response, tells whether the connection can be reused after it
+    buffer = bytearray()
+    while b"\r\n\r\n" not in buffer:
+        chunk = s.recv(RECV_SIZE)
+        if not chunk:
+            return bytes(buffer), False
+        buffer += chunk
+
+    header_data, _, body = bytes(buffer).partition(b"\r\n\r\n")
+    content_length = 0
+    keep_alive = True
+    for line in header_data.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            content_length = int(value)
+        elif name == b"connection" and value.strip().lower() == b"close":
+            keep_alive = False
+
+    chunks = [header_data, b"\r\n\r\n", body]
+    received = len(body)
+    while received < content_length:
+        chunk = s.recv(RECV_SIZE)
+        if not chunk:
+            keep_alive = False
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+    # anything past Content-Length means the stream is out of sync, so don't reuse it
+    if received > content_length:
+        keep_alive = False
+    return b"".join(chunks), keep_alive
+
+
 def make_request(path):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            request = f"GET {path} HTTP/1.1\r\nHost: {HOST}\r\n\r\n"
-            s.sendall(request.encode())
-
-            response = b""
-            while True:
-                chunk = s.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-            first_line = response.decode(errors='ignore').splitlines()[0]
-            with lock:
-                results.append(first_line)
-                print(f"{first_line} for {path} ({len(response)} bytes)")
+        request = f"GET {path} HTTP/1.1\r\nHost: {HOST}\r\nConnection: keep-alive\r\n\r\n".encode()
+        while True:
+            s, reused = get_connection()
+            try:
+                s.sendall(request)
+                response, keep_alive = read_response(s)
+            except OSError:
+                s.close()
+                if reused:
+                    continue  # the server dropped the idle connection, try a fresh one
+                raise
+            if not response and reused:
+                s.close()
+                continue
+            break
+
+        if keep_alive:
+            idle_connections.put(s)
+        else:
+            s.close()
+
+        first_line = response.split(b"\r\n", 1)[0].decode(errors='ignore')
+        with lock:
+            results.append(first_line)
+            print(f"{first_line} for {path} ({len(response)} bytes)")
 
     except Exception as e:
         with lock:
             results.append("ERROR")
             print(f"Error requesting {path}: {e}")
 
+
 threads = []
 start_time = time.time()
 
@@ -1,22 +1,87 @@
+import asyncio
+import atexit
+import itertools
+from concurrent.futures import Future
+from contextlib import contextmanager
 import random
 import threading
-import time
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import aiohttp
 import logging
-from flask import Flask, request, jsonify
+import math
+import orjson
+from flask import Flask, request
 import os
 
+try:
+    import uvloop  # libuv based loop, not available on windows
+except ImportError:
+    uvloop = None
+
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-executor = ThreadPoolExecutor(max_workers=100)
 
-store = {}
-store_lock = threading.Lock()
+class RWLock:
+    # many readers or one writer; waiting writers block new readers so writes don't starve
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+# the store is split into shards, each with its own lock, so writes to unrelated keys don't contend
+SHARD_COUNT = 32
+# each shard keeps values and versions in two parallel dicts, so version checks only touch ints
+SHARDS = [({}, {}, RWLock()) for _ in range(SHARD_COUNT)]
+# notified after every write to a shard, wakes up /wait_version long-polls
+SHARD_CONDITIONS = [threading.Condition() for _ in range(SHARD_COUNT)]
+
+# every blocked long-poll holds a server thread (gunicorn runs 64), so keep both the count and the
+# wait short enough that /replicate_batch always finds a free thread
+WAIT_VERSION_MAX_TIMEOUT = 5
+WAIT_VERSION_MAX_WAITERS = 16
+wait_version_slots = threading.BoundedSemaphore(WAIT_VERSION_MAX_WAITERS)
 
-current_version = 0
-current_version_lock = threading.Lock()
+# bumped under the shard's write lock on every write, their sum changes whenever the store does
+SHARD_EPOCHS = [0] * SHARD_COUNT
+
+# last serialized /dump, reused until the epoch moves; boot_id keeps etags from an old process from matching
+dump_cache = {"epoch": -1, "body": b""}
+dump_cache_lock = threading.Lock()
+boot_id = os.urandom(4).hex()
+
+# next() on itertools.count is a single C call, so it's atomic under the GIL without a lock
+version_counter = itertools.count(1)
 
 ROLE = os.getenv("ROLE", "follower")
 PORT = int(os.getenv("PORT", "5000"))
@@ -36,87 +101,311 @@ else:
 
 # helpers
 def get_next_version():
-    global current_version
+    return next(version_counter)
+
+
+def json_response(payload, status=200):
+    # orjson is much faster than the stdlib encoder behind jsonify
+    return app.response_class(orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+                              status=status, mimetype="application/json")
+
+
+def parse_json():
+    # orjson straight from the raw body, bad json gets the same 400 as a missing field
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+
+
+def is_valid_entry(entry):
+    # a str version or an unhashable key would break every later compare on that key
+    if not isinstance(entry, dict) or "key" not in entry or "value" not in entry:
+        return False
+    version = entry.get("version", 0)
+    return isinstance(entry["key"], str) and isinstance(version, int) and not isinstance(version, bool)
+
+
+def get_shard_index(key):
+    return hash(key) % SHARD_COUNT
+
+
+def notify_shard(index):
+    cond = SHARD_CONDITIONS[index]
+    with cond:
+        cond.notify_all()
+
+
+def is_stale(versions, key, version):
+    # versions only grow, so a stale write stays stale and can be dropped without locking
+    old = versions.get(key)
+    return old is not None and version < old
+
+
+def apply_unlocked(values, versions, key, value, version):
+    # caller must hold the shard's write lock
+    old = versions.get(key)
+    if old is None or version >= old:
+        values[key] = value
+        versions[key] = version
 
-    with current_version_lock:
-        current_version += 1
-        return current_version
+
+def read_entry(index, key):
+    # value and version live in separate dicts, read them together under the read lock
+    values, versions, shard_lock = SHARDS[index]
+    with shard_lock.read_lock():
+        if key not in versions:
+            return None
+        return values[key], versions[key]
 
 
 def apply_local(key, value, version):
-    with store_lock:
-        old = store.get(key)
-        if old is None or version >= old["version"]:
-            store[key] = {"value": value, "version": version}
+    index = get_shard_index(key)
+    values, versions, shard_lock = SHARDS[index]
+    if is_stale(versions, key, version):
+        return
+
+    with shard_lock.write_lock():
+        apply_unlocked(values, versions, key, value, version)
+        SHARD_EPOCHS[index] += 1
+    notify_shard(index)
+
+
+def apply_local_batch(entries):
+    # group the batch by shard so each shard lock is taken once
+    by_shard = {}
+    for entry in entries:
+        by_shard.setdefault(get_shard_index(entry["key"]), []).append(entry)
+
+    for index, shard_entries in by_shard.items():
+        values, versions, shard_lock = SHARDS[index]
+        shard_entries = [entry for entry in shard_entries
+                         if not is_stale(versions, entry["key"], entry.get("version", 0))]
+        if not shard_entries:
+            continue
+
+        with shard_lock.write_lock():
+            for entry in shard_entries:
+                apply_unlocked(values, versions, entry["key"], entry["value"], entry.get("version", 0))
+            SHARD_EPOCHS[index] += 1
+        notify_shard(index)
 
 
 @app.route("/ping")
 def ping():
-    return jsonify({"role": ROLE, "status": "ok"})
+    return json_response({"role": ROLE, "status": "ok"})
 
 
 # follower only endpoint
 if ROLE == "follower":
     @app.route("/replicate", methods=["POST"])
     def replicate():
-        data = request.get_json()
-        if not data or "key" not in data or "value" not in data:
-            return jsonify({"error": "Invalid request"}), 400
+        data = parse_json()
+        if not is_valid_entry(data):
+            return json_response({"error": "Invalid request"}, 400)
 
         key = data["key"]
         value = data["value"]
         version = data.get("version", 0)
 
         apply_local(key, value, version)
-        return jsonify({"status": "replicated"}), 200
+        return json_response({"status": "replicated"}, 200)
+
+    @app.route("/replicate_batch", methods=["POST"])
+    def replicate_batch():
+        entries = parse_json()
+        if not isinstance(entries, list) or not all(is_valid_entry(entry) for entry in entries):
+            return json_response({"error": "Invalid request"}, 400)
+
+        apply_local_batch(entries)
+        return json_response({"status": "replicated", "count": len(entries)}, 200)
 
 
 # leader only
 if ROLE == "leader":
-    def replicate_to_one_follower(url, key, value, version):
-        delay = random.uniform(MIN_DELAY, MAX_DELAY) / 1000
-        time.sleep(delay)
+    # all replication runs on one event loop in a background thread,
+    # Flask request threads hand it coroutines and wait for the result
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="replication-loop", daemon=True).start()
+    background_tasks = set()  # batches still in flight after their writes got a quorum
+    flushers = []
+    pending = {}  # follower url -> queue of entries waiting to be batched
+    waiters = {}  # version -> ack state of a write still waiting for its quorum
+
+    # only the loop thread updates these, so no lock is needed; the keys are fixed up front
+    # so /metrics can copy the dict from a request thread while it's being updated
+    replication_metrics = {
+        "batches_sent": 0,
+        "batches_failed": 0,
+        "entries_sent": 0,
+        "entries_failed": 0,
+        "writes_committed": 0,
+        "writes_failed": 0,
+    }
+
+    BATCH_SIZE = 32
+    BATCH_WINDOW = 0.001  # seconds a flusher waits for more writes to join a batch
+
+    # simulated network delays drawn once at startup, in seconds, instead of one random.uniform per batch
+    DELAY_RING_SIZE = 1 << 16
+    DELAY_RING = [random.uniform(MIN_DELAY, MAX_DELAY) / 1000 for _ in range(DELAY_RING_SIZE)]
+    delay_index = itertools.count()
+
+
+    def next_delay():
+        return DELAY_RING[next(delay_index) & (DELAY_RING_SIZE - 1)]
+
+
+    def submit_coro(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+    async def create_client_session():
+        # one pooled keep-alive session for all followers
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=200, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=5)
+        )
+
+
+    client_session = submit_coro(create_client_session()).result()
+
+
+    async def shutdown():
+        for flusher in flushers:
+            flusher.cancel()
+        await asyncio.gather(*flushers, return_exceptions=True)
+        await client_session.close()
+
+
+    atexit.register(lambda: submit_coro(shutdown()).result(timeout=1))
+
+
+    async def prewarm_connections():
+        # open one connection per follower up front so the first write doesn't pay the handshake
+        for fol in FOLLOWERS:
+            try:
+                async with client_session.get(f"{fol}/ping", timeout=aiohttp.ClientTimeout(total=1)):
+                    pass
+            except Exception as e:
+                logger.warning(f"Could not prewarm connection to {fol}: {e}")
+
+
+    submit_coro(prewarm_connections())
+
+
+    async def replicate_to_one_follower(url, batch):
+        # batch holds (version, payload) pairs, each payload already encoded by replicate_to_followers
+        body = b"[" + b",".join(payload for _, payload in batch) + b"]"
+
+        await asyncio.sleep(next_delay())
 
         try:
-            response = requests.post(
-                f"{url}/replicate",
-                json={"key": key, "value": value, "version": version},
-                timeout=5
-            )
-            # if response.status_code == 200:
-            #     with results_lock:
-            #         results.append(True)
-            return response.status_code == 200
+            async with client_session.post(
+                f"{url}/replicate_batch",
+                data=body,
+                headers={"Content-Type": "application/json"}
+            ) as response:
+                ok = response.status == 200
         except Exception as e:
             logger.error(f"Replicate to {url} EXCEPTION: {e}")
-            return False
+            ok = False
+
+        if ok:
+            replication_metrics["batches_sent"] += 1
+            replication_metrics["entries_sent"] += len(batch)
+        else:
+            replication_metrics["batches_failed"] += 1
+            replication_metrics["entries_failed"] += len(batch)
+
+        for version, _ in batch:
+            record_ack(version, ok)
+
+
+    def record_ack(version, ok):
+        waiter = waiters.get(version)
+        if waiter is None:
+            return  # write already got its answer
+
+        if ok:
+            waiter["acks"] += 1
+        else:
+            waiter["failures"] += 1
+
+        if waiter["acks"] >= WRITE_QUORUM:
+            success = True
+        elif waiter["acks"] + waiter["failures"] == len(FOLLOWERS):
+            success = False
+        else:
+            return
+
+        del waiters[version]
+        replication_metrics["writes_committed" if success else "writes_failed"] += 1
+        waiter["done"].set_result((success, waiter["acks"]))
+
+
+    async def flush_to_follower(url):
+        queue = pending[url]
+        while True:
+            batch = [await queue.get()]
+            # give concurrent writes a moment to join, but never more than BATCH_SIZE
+            await asyncio.sleep(BATCH_WINDOW)
+            while len(batch) < BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            task = asyncio.ensure_future(replicate_to_one_follower(url, batch))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+
+    async def start_flushers():
+        for fol in FOLLOWERS:
+            pending[fol] = asyncio.Queue()
+            flushers.append(asyncio.ensure_future(flush_to_follower(fol)))
+
+
+    submit_coro(start_flushers()).result()
+
+
+    def enqueue_write(version, payload, done=None):
+        # runs on the loop; done is resolved by record_ack once the write has its answer
+        if done is not None:
+            waiters[version] = {"acks": 0, "failures": 0, "done": done}
+
+        entry = (version, payload)
+        for fol in FOLLOWERS:
+            pending[fol].put_nowait(entry)
 
 
     def replicate_to_followers(key, value, version):
         if not FOLLOWERS:
             return True, 0
 
-        futures = []
-        for fol in FOLLOWERS:
-            future = executor.submit(replicate_to_one_follower, fol, key, value, version)
-            futures.append(future)
+        # encode once here, on the request thread, and share the bytes with every follower's batch
+        payload = orjson.dumps({"key": key, "value": value, "version": version})
 
-        ack_count = 0
+        if WRITE_QUORUM <= 0:
+            # no acks needed, the flushers replicate it in the background
+            loop.call_soon_threadsafe(enqueue_write, version, payload)
+            return True, 0
+
+        # a plain callback plus a thread-safe future, no task per write
+        done = Future()
+        loop.call_soon_threadsafe(enqueue_write, version, payload, done)
+        return done.result()
 
-        for f in as_completed(futures):
-            if f.result():
-                ack_count += 1
-                if ack_count >= WRITE_QUORUM:
-                    return True, ack_count
 
-        return False, ack_count
+    @app.route("/metrics")
+    def metrics():
+        return json_response(dict(replication_metrics))
 
 
     @app.route("/write", methods=["POST"])
     def write():
-        data = request.get_json()
-        if not data or "key" not in data or "value" not in data:
-            return jsonify({"error": "Invalid request"}), 400
+        data = parse_json()
+        # followers only take str keys, so the leader must not accept anything else
+        if not isinstance(data, dict) or "key" not in data or "value" not in data or not isinstance(data["key"], str):
+            return json_response({"error": "Invalid request"}, 400)
 
         key = data["key"]
         value = data["value"]
@@ -125,19 +414,19 @@ if ROLE == "leader":
         apply_local(key, value, version)
         success, acks = replicate_to_followers(key, value, version)
         if success:
-            return jsonify({
+            return json_response({
                 "status": "write committed",
                 "acks": acks,
                 "version": version,
                 "required_quorum": WRITE_QUORUM
-            }), 200
+            })
 
-        return jsonify({
+        return json_response({
             "status": "write failed",
             "acks": acks,
             "version": version,
             "required_quorum": WRITE_QUORUM
-        }), 503
+        }, 503)
         # results = []
         # threads = []
         #
@@ -185,18 +474,82 @@ if ROLE == "leader":
 @app.route("/read", methods=["GET"])
 def read():
     key = request.args.get("key")
-    with store_lock:
-        if key in store:
-            return jsonify({"value": store[key]})
-        else:
-            return jsonify({"error": "Key not found"}), 404
+    entry = read_entry(get_shard_index(key), key)
+    if entry is None:
+        return json_response({"error": "Key not found"}, 404)
+
+    value, version = entry
+    return json_response({"value": {"value": value, "version": version}})
+
+
+@app.route("/wait_version", methods=["GET"])
+def wait_version():
+    # long-poll: answers as soon as the key reaches the version instead of making the client poll /read
+    key = request.args.get("key")
+    try:
+        version = int(request.args.get("version", ""))
+        timeout = float(request.args.get("timeout", 5))
+    except ValueError:
+        return json_response({"error": "Invalid request"}, 400)
+
+    # nan or inf would make wait_for block forever and pin a server thread
+    if key is None or not math.isfinite(timeout):
+        return json_response({"error": "Invalid request"}, 400)
+    timeout = max(0.0, min(timeout, WAIT_VERSION_MAX_TIMEOUT))
+
+    index = get_shard_index(key)
+    _, versions, _ = SHARDS[index]
+
+    def reached():
+        current = versions.get(key)
+        return current is not None and current >= version
+
+    if not reached():
+        if not wait_version_slots.acquire(blocking=False):
+            return json_response({"error": "Too many waiters"}, 503)
+        try:
+            cond = SHARD_CONDITIONS[index]
+            with cond:
+                cond.wait_for(reached, timeout)
+        finally:
+            wait_version_slots.release()
+
+    entry = read_entry(index, key)
+    if entry is None or entry[1] < version:
+        return json_response({"error": "Version not reached", "version": entry[1] if entry else None}, 408)
+
+    value, entry_version = entry
+    return json_response({"value": {"value": value, "version": entry_version}})
 
 
 @app.route("/dump")
 def dump():
-    with store_lock:
-        return jsonify(store)
+    # read the epoch before the snapshot, a write that races with it only makes the cached body newer
+    epoch = sum(SHARD_EPOCHS)
+    with dump_cache_lock:
+        if dump_cache["epoch"] != epoch:
+            # sorted so replicas holding the same data return byte-identical dumps
+            dump_cache["body"] = orjson.dumps(snapshot_store(), option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS)
+            dump_cache["epoch"] = epoch
+        body = dump_cache["body"]
+
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(f"{boot_id}-{epoch}")
+    # answers 304 when the client's If-None-Match still matches
+    return response.make_conditional(request)
+
+
+def snapshot_store():
+    # shards are copied one at a time, so the snapshot is not atomic across shards
+    snapshot = {}
+    for values, versions, shard_lock in SHARDS:
+        with shard_lock.read_lock():
+            entries = [(key, values[key], version) for key, version in versions.items()]
+        for key, value, version in entries:
+            snapshot[key] = {"value": value, "version": version}
+    return snapshot
 
 
 if __name__ == "__main__":
+    # dev server for local runs, the container serves app:app through gunicorn
     app.run(host="0.0.0.0", port=PORT, threaded=True)
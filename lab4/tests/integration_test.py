@@ -1,3 +1,4 @@
+import json
 import os
 import time
 import requests
@@ -13,6 +14,8 @@ FOLLOWERS = [
     "http://localhost:5005",
 ]
 
+session = requests.Session()  # keep-alive connections for the dump calls
+
 
 def wait_cluster_ready(timeout=20):
     dead = time.time() + timeout
@@ -37,27 +40,26 @@ def restart_with_quorum(q):
     wait_cluster_ready()
 
 
+def check_follower(fol, key, version, timeout):
+    # /wait_version holds the request until the follower has the version, no polling needed
+    r = requests.get(
+        f"{fol}/wait_version",
+        params={"key": key, "version": version, "timeout": timeout},
+        timeout=timeout + 1
+    )
+    return r.status_code == 200 and r.json()["value"]["version"] == version
+
+
 def wait_replication(key, version, timeout=5):
-    start = time.time()
-    while time.time() - start < timeout:
-        all_ok = True
-        for fol in FOLLOWERS:
-            r = requests.get(f"{fol}/read?key={key}")
-            if r.status_code != 200:
-                all_ok = False
-                break
-            if r.json()["value"]["version"] != version:
-                all_ok = False
-                break
-        if all_ok:
-            return True
-        time.sleep(0.1)
-    return False
+    with ThreadPoolExecutor(max_workers=len(FOLLOWERS)) as pool:
+        futures = [pool.submit(check_follower, fol, key, version, timeout) for fol in FOLLOWERS]
+        return all(f.result() for f in as_completed(futures))
 
 
 def dump(url):
-    r = requests.get(f"{url}/dump")
-    return r.json() if r.status_code == 200 else {}
+    # raw body: /dump sorts its keys, so two replicas in sync send exactly the same bytes
+    r = session.get(f"{url}/dump")
+    return r.content if r.status_code == 200 else b"{}"
 
 
 def test_basic_write_read():
@@ -151,11 +153,19 @@ def test_no_write_to_followers():
 def test_final_cluster_consistency():
     print("\n=== Test 5: Full cluster consistency ===")
     time.sleep(1)
-    leader_data = dump(LEADER)
-
-    for fol in FOLLOWERS:
-        fol_data = dump(fol)
-
+    # leader and followers are dumped in parallel
+    with ThreadPoolExecutor(max_workers=len(FOLLOWERS) + 1) as pool:
+        leader_future = pool.submit(dump, LEADER)
+        follower_dumps = list(pool.map(dump, FOLLOWERS))
+        leader_body = leader_future.result()
+
+    for fol, fol_body in zip(FOLLOWERS, follower_dumps):
+        # equal bytes means equal stores, the json is only parsed to report a mismatch
+        if fol_body == leader_body:
+            continue
+
+        leader_data = json.loads(leader_body)
+        fol_data = json.loads(fol_body)
         if fol_data != leader_data:
             print(f"❌ Mismatch on {fol}")
             print("\nLeader state:")